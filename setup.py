@@ -19,12 +19,12 @@ INSTALL_REQUIRES = [
     "click-repl",
     "compoundfiles",
     "compressed-rtf",
-    "gron",
     "halo",
     "jinja2",
     "more-itertools",
     "msg_parser",
     "olefile",
+    "orjson",
     "pyyaml",
     "requests",
     "six",
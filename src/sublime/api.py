@@ -7,6 +7,7 @@ import datetime
 
 import requests
 import structlog
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 
 from sublime.__version__ import __version__
 from sublime.error import RateLimitError, InvalidRequestError, APIError, AuthenticationError
@@ -49,6 +50,25 @@ class Sublime(object):
             api_key = config.get("api_key")
         self._api_key = api_key
         self.session = requests.Session()
+        self._pool_size = DEFAULT_POOLSIZE
+
+    def set_pool_size(self, pool_size):
+        """Keep up to pool_size connections alive for concurrent requests.
+
+        Requests made by more threads than the pool holds open connections
+        that are thrown away afterwards. The pool is never shrunk.
+
+        :param pool_size: Number of connections to keep per host.
+        :type pool_size: int
+
+        """
+        if pool_size <= self._pool_size:
+            return
+
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._pool_size = pool_size
 
     def _is_public_endpoint(self, endpoint):
         if endpoint in [self._EP_PUBLIC_BINEXPLODE_SCAN, self._EP_MESSAGES_ANALYZE, self._EP_MESSAGES_CREATE]:
@@ -12,12 +12,25 @@ import structlog
 from requests.exceptions import RequestException
 
 from sublime.api import Sublime
-from sublime.cli.formatter import FORMATTERS, ANSI_MARKUP
-from sublime.error import *
+from sublime.cli.formatter import FORMATTERS, ansi_markup
+from sublime.error import (
+    APIError,
+    AuthenticationError,
+    InvalidRequestError,
+    LoadEMLError,
+    LoadMSGError,
+    LoadMessageDataModelError,
+    LoadRuleError,
+    RateLimitError,
+)
 from sublime.util import load_config
 
 LOGGER = structlog.get_logger()
 
+# large MDM/analyze outputs are written in a handful of big writes
+# rather than thousands of small ones
+OUTPUT_BUFFER_SIZE = 1 << 20
+
 
 def echo_result(function):
     """Decorator that prints subcommand results correctly formatted.
@@ -34,66 +47,57 @@ def echo_result(function):
         result = function(*args, **kwargs)
         context = click.get_current_context()
         params = context.params
-        if params.get("output_format"):
-            output_format = params["output_format"]
+        output_format = params.get("output_format") or "txt"
+        output_file = params.get("output_file")
+        verbose = params.get("verbose", False)
+        command_name = context.command.name
+
+        if output_format == "json":
+            # a single json formatter serves every subcommand
+            name = None
+        elif isinstance(context.parent.command, click.Group) and \
+                context.parent.command.name != 'main':
+            # sub-sub command
+            name = f"{context.parent.command.name}_{command_name}"
         else:
-            output_format = "txt"
-        formatter = FORMATTERS[output_format]
-        config = load_config()
-        if isinstance(formatter, dict):
-            # For the text formatter, there's a separate formatter for each 
-            if isinstance(context.parent.command, click.Group) and \
-                    context.parent.command.name != 'main':
-                # sub-sub command
-                parent_name = context.parent.command.name
-                cur_name = context.command.name
-                name = f"{parent_name}_{cur_name}"
-                formatter = formatter[name]
-            else:
-                # regular subcommand
-                formatter = formatter[context.command.name]
-
-        if context.command.name in ("create", "binexplode"):
+            # regular subcommand
+            name = command_name
+        formatter = FORMATTERS[(output_format, name)]
+
+        if command_name in ("create", "binexplode"):
             # default behavior is to always save the MDM and binexplode output
             # even if no output file is specified
-            if not params.get("output_file"):
-                input_file_relative_name = params.get('input_file').name
-                input_file_relative_no_ext, _ = os.path.splitext(
-                        input_file_relative_name)
-                input_file_name_no_ext = os.path.basename(
-                        input_file_relative_no_ext)
-                output_file_name = f'{input_file_name_no_ext}'
-
-                if output_format == "json":
-                    if context.command.name == "create":
-                        output_file_name += ".mdm"
-                    else:
-                        output_file_name += ".json"
-                elif output_format == "txt":
-                    output_file_name += ".txt"
+            if not output_file:
+                input_file_name = os.path.basename(params["input_file"].name)
+                stem, _ = os.path.splitext(input_file_name)
+                if output_format == "txt":
+                    extension = "txt"
+                elif command_name == "create":
+                    extension = "mdm"
+                else:
+                    extension = "json"
+                output_file_name = f"{stem}.{extension}"
 
                 # if the user has a default save directory configured,
                 # store the file there
-                if config["save_dir"]:
-                    output_file_name = os.path.join(config["save_dir"], output_file_name)
+                save_dir = load_config()["save_dir"]
+                if save_dir:
+                    output_file_name = os.path.join(save_dir, output_file_name)
 
-                params["output_file"] = click.open_file(output_file_name, mode="w")
+                output_file = open(
+                        output_file_name, mode="w", buffering=OUTPUT_BUFFER_SIZE)
 
-            if context.command.name == "create":
+            if command_name == "create":
                 # strip the extra info and just save the unenriched MDM
                 result = result["data_model"]
 
-        output = formatter(result, 
-                params.get("verbose", False)).strip("\n")
+        output = formatter(result, verbose).strip("\n")
 
-        click.echo(
-            output, 
-            file=params.get("output_file", click.open_file("-", mode="w"))
-        )
+        click.echo(output, file=output_file or click.get_text_stream("stdout"))
 
-        file_name = params.get("output_file")
-        if file_name:
-            click.echo(ANSI_MARKUP(f"Output saved to <bold>{file_name.name}</bold>"))
+        if output_file:
+            output_file.flush()
+            click.echo(ansi_markup(f"Output saved to <bold>{output_file.name}</bold>"))
 
     return wrapper
 
@@ -112,15 +116,7 @@ def handle_exceptions(function):
     def wrapper(*args, **kwargs):
         try:
             return function(*args, **kwargs)
-        except RateLimitError as error:
-            error_message = "API error: {}".format(error.message)
-            LOGGER.error(error_message)
-            click.get_current_context().exit(-1)
-        except InvalidRequestError as error:
-            error_message = "API error: {}".format(error.message)
-            LOGGER.error(error_message)
-            click.get_current_context().exit(-1)
-        except APIError as error:
+        except (RateLimitError, InvalidRequestError, APIError) as error:
             error_message = "API error: {}".format(error.message)
             LOGGER.error(error_message)
             click.get_current_context().exit(-1)
@@ -170,6 +166,22 @@ def handle_exceptions(function):
     return wrapper
 
 
+@functools.lru_cache(maxsize=4)
+def get_api_client(api_key):
+    """Get an API client for the given key.
+
+    Clients are reused across subcommands run in the same process (e.g. from
+    the repl) so that their session keeps its pooled connections alive.
+
+    :param api_key: Key used to access the API.
+    :type api_key: str
+    :returns: API client
+    :rtype: Sublime
+
+    """
+    return Sublime(api_key=api_key)
+
+
 def pass_api_client(function):
     """Create API client form API key and pass it to subcommand.
 
@@ -183,28 +195,9 @@ def pass_api_client(function):
     @functools.wraps(function)
     def wrapper(*args, **kwargs):
         context = click.get_current_context()
+        # the client reads the configured key itself when none is passed
         api_key = context.params.get("api_key")
-        config = load_config()
-
-        if api_key is None:
-            if not config["api_key"]:
-                pass
-                '''
-                prog_name = context.parent.info_name
-                click.echo(
-                    "\nError: API key not found.\n\n"
-                    "To fix this problem, please use any of the following methods "
-                    "(in order of precedence):\n"
-                    "- Pass it using the -k/--api-key option.\n"
-                    "- Set it in the SUBLIME_API_KEY environment variable.\n"
-                    "- Run 'setup -k' to save it to the configuration file.\n"
-                )
-                context.exit(-1)
-                '''
-            else:
-                api_key = config["api_key"]
-
-        api_client = Sublime(api_key=api_key)
+        api_client = get_api_client(api_key)
         return function(api_client, *args, **kwargs)
 
     return wrapper
@@ -216,7 +209,7 @@ def create_command(function):
     @click.command()
     @click.option("-k", "--api-key", help="Key to include in API requests [optional]")
     @click.option(
-        "-i", "--input", "input_file", type=click.File(), 
+        "-i", "--input", "input_file", type=click.File(mode="rb"), 
         help="Input EML file", required=True
     )
     @click.option("-t", "--type", "message_type",
@@ -300,6 +293,20 @@ def analyze_command(function):
         default="txt",
         help="Output format")
 
+    @click.option("-p", "--parallel", "parallel",
+        type=click.IntRange(min=1),
+        default=8,
+        show_default=True,
+        envvar="SUBLIME_ANALYZE_WORKERS",
+        show_envvar=True,
+        help="Number of messages to analyze concurrently")
+
+    @click.option("--no-cache", "no_cache",
+        is_flag=True,
+        envvar="SUBLIME_NO_CACHE",
+        show_envvar=True,
+        help="Don't reuse or save parsed rules and delete any saved ones")
+
     @pass_api_client
     @click.pass_context
     @echo_result
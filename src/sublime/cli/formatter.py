@@ -3,54 +3,116 @@
 
 from __future__ import print_function
 
-import re
 import functools
 import json
-from xml.dom.minidom import parseString
+import re
 
-import gron
-import ansimarkup
-import click
 import colorama
-from jinja2 import Environment, PackageLoader
-
-JINJA2_ENV = Environment(loader=PackageLoader("sublime.cli"),
-                         extensions=['jinja2.ext.loopcontrols'])
-
-colorama.init()
-ANSI_MARKUP = ansimarkup.AnsiMarkup(
-    tags={
-        "header": ansimarkup.parse("<bold>"),
-        "key": ansimarkup.parse("<cyan>"),
-        "value": ansimarkup.parse("<green>"),
-        "not-detected": ansimarkup.parse("<dim>"),
-        "fail": ansimarkup.parse("<light-red>"),
-        "success": ansimarkup.parse("<green>"),
-        "unknown": ansimarkup.parse("<dim>"),
-        "detected": ansimarkup.parse("<light-green>"),
-        "enrichment": ansimarkup.parse("<light-yellow>"),
-        "warning": ansimarkup.parse("<light-yellow>"),
-        "query": ansimarkup.parse("<white>"),
-    }
-)
 
 
-def colored_output(function):
-    """Decorator that converts ansi markup into ansi escape sequences.
+@functools.lru_cache(maxsize=None)
+def get_template(name):
+    """Get a compiled template, loading it on first use.
 
-    :param function: Function that will return text using ansi markup.
-    :type function: callable
-    :returns: Wrapped function that converts markup into escape sequences.
-    :rtype: callable
+    Jinja2 is only imported once a text formatter needs it, so json output
+    does not pay for building the environment.
+
+    :param name: Template file name.
+    :type name: str
+    :returns: Compiled template.
+    :rtype: jinja2.Template
 
     """
+    return get_jinja2_env().get_template(name)
+
+
+@functools.lru_cache(maxsize=1)
+def get_jinja2_env():
+    """Get the Jinja2 environment used to render the text templates."""
+    from jinja2 import Environment, PackageLoader
+
+    env = Environment(loader=PackageLoader("sublime.cli"),
+                      extensions=['jinja2.ext.loopcontrols'],
+                      auto_reload=False,
+                      cache_size=-1)
+    env.filters['format_result'] = format_result
+    return env
+
+
+@functools.lru_cache(maxsize=1)
+def init_colorama():
+    """Initialize colorama once, the first time colored output is produced."""
+    colorama.init()
+
+
+# markup tags the templates use, and the ansimarkup style each one maps to
+ANSI_TAGS = {
+    "bold": "bold",
+    "header": "bold",
+    "key": "cyan",
+    "value": "green",
+    "not-detected": "dim",
+    "fail": "light-red",
+    "success": "green",
+    "unknown": "dim",
+    "detected": "light-green",
+    "enrichment": "light-yellow",
+    "warning": "light-yellow",
+    "query": "white",
+}
+ANSI_TAG_RE = re.compile(
+    "<(/?)({})>".format("|".join(re.escape(tag) for tag in ANSI_TAGS)))
 
-    @functools.wraps(function)
-    def wrapper(*args, **kwargs):
-        output = function(*args, **kwargs)
-        return ANSI_MARKUP(output)
 
-    return wrapper
+@functools.lru_cache(maxsize=1)
+def get_ansi_codes():
+    """Get the escape sequence for every markup tag in ANSI_TAGS.
+
+    ansimarkup is only imported once colored output is produced.
+
+    :returns: Escape sequences keyed by markup tag.
+    :rtype: dict
+
+    """
+    import ansimarkup
+
+    return {
+        tag: ansimarkup.parse("<{}>".format(style))
+        for tag, style in ANSI_TAGS.items()
+    }
+
+
+def ansi_markup(text):
+    """Convert ansi markup into ansi escape sequences.
+
+    Behaves like ansimarkup for the tags in ANSI_TAGS: a closing tag resets
+    the style and restores the tags that are still open. Anything else that
+    looks like a tag (e.g. an email address in angle brackets) is kept.
+
+    :param text: Text using ansi markup.
+    :type text: str
+    :returns: Text with markup converted into escape sequences.
+    :rtype: str
+
+    """
+    init_colorama()
+    codes = get_ansi_codes()
+    open_tags = []
+    open_codes = []
+
+    def substitute(match):
+        closing, tag = match.groups()
+        if not closing:
+            open_tags.append(tag)
+            open_codes.append(codes[tag])
+            return codes[tag]
+        if open_tags and open_tags[-1] == tag:
+            open_tags.pop()
+            open_codes.pop()
+            return colorama.Style.RESET_ALL + "".join(open_codes)
+        return match.group(0)
+
+    return ANSI_TAG_RE.sub(substitute, text)
 
 
 def json_formatter(result, verbose=False, indent=4, offset=0):
@@ -60,6 +122,19 @@ def json_formatter(result, verbose=False, indent=4, offset=0):
     return string
 
 
+def format_result(result):
+    """Format a rule or query result for the text templates.
+
+    :param result: Result value returned by the API.
+    :type result: dict, list, str, int, float, bool or None
+    :returns: Indented json for objects and arrays, the value itself otherwise.
+
+    """
+    if isinstance(result, (dict, list)):
+        return json_formatter(result, offset=2, indent=2)
+    return result
+
+
 def filter_none_recursive(item):
     """Recursive Filter Out Values"""
     if isinstance(item, list):
@@ -67,14 +142,48 @@ def filter_none_recursive(item):
     return item
 
 
-@colored_output
+def gron_flatten(node, path):
+    """Flatten a decoded JSON value into gron assignment statements.
+
+    Mirrors gron's output (sorted object members, unescaped strings) while
+    walking the Python objects directly instead of a JSON string.
+
+    :param node: Decoded JSON value.
+    :type node: dict, list, str, int, float, bool or None
+    :param path: Path of the value, e.g. ``json.headers``.
+    :type path: str
+    :returns: One ``path = value;`` statement per line.
+    :rtype: str
+
+    """
+    if node is None:
+        return f"{path} = null;"
+    if isinstance(node, bool):
+        return f"{path} = {str(node).lower()};"
+    if isinstance(node, str):
+        return f'{path} = "{node}";'
+    if isinstance(node, dict):
+        statements = [f"{path} = {{}};"]
+        for key, value in node.items():
+            if "-" in key or " " in key:
+                child_path = f'{path}["{key}"]'
+            else:
+                child_path = f"{path}.{key}"
+            statements.append(gron_flatten(value, child_path))
+        return "\n".join(sorted(statements))
+    if isinstance(node, list):
+        statements = [f"{path} = [];"]
+        for index, value in enumerate(node):
+            statements.append(gron_flatten(value, f"{path}[{index}]"))
+        return "\n".join(statements)
+
+    return f"{path} = {node!r};"
+
+
 def analyze_formatter(results, verbose):
     """Convert Analyze output into human-readable text."""
-    mql_offset = 3
-    json_offset = 2
-    template_file = "analyze_multi.txt.j2" if len(
-        results) > 1 else "analyze.txt.j2"
-    template = JINJA2_ENV.get_template(template_file)
+    template = get_template(
+        "analyze_multi.txt.j2" if len(results) > 1 else "analyze.txt.j2")
 
     # calculate total stats
     sample_result = next(iter(results.values()))
@@ -139,31 +248,24 @@ def analyze_formatter(results, verbose):
     summary_stats['flagged_rules'] = len(all_flagged_rules)
     summary_stats['flagged_messages'] = len(flagged_messages)
 
-    # format mql and json outputs
-    for msg in flagged_messages + unflagged_messages:
-        for result in msg['rule_results'] + msg['query_results']:
-            if 'result' in result and (isinstance(result['result'], dict) or isinstance(result['result'], list)):
-                result['result'] = json_formatter(
-                    result['result'],
-                    offset=json_offset,
-                    indent=2)
-
     # TO DO: sort each list of messages by extension and file name (or directory?)
 
-    return template.render(
-        stats=summary_stats,
-        flagged_messages=flagged_messages,
-        unflagged_messages=unflagged_messages,
-        rules=rules,
-        queries=queries,
-        verbose=verbose)
+    context = {
+        'stats': summary_stats,
+        'flagged_messages': flagged_messages,
+        'unflagged_messages': unflagged_messages,
+        'rules': rules,
+        'queries': queries,
+        'verbose': verbose,
+    }
+    return ansi_markup(template.render(context))
 
 
 def mdm_formatter(results, verbose):
     """Convert Message Data Model into human-readable text."""
-    gron_output = gron.gron(json.dumps(results))
-    gron_output = gron_output.replace('json = {}', 'message_data_model = {}')
-    gron_output = re.sub(r'\njson\.', '\n', gron_output)
+    gron_output = gron_flatten(results, "json")
+    gron_output = gron_output.replace("json = {}", "message_data_model = {}")
+    gron_output = gron_output.replace("\njson.", "\n")
 
     return gron_output
 
@@ -171,28 +273,22 @@ def mdm_formatter(results, verbose):
     # return template.render(results=results, verbose=verbose)
 
 
-@colored_output
 def me_formatter(result, verbose):
     """Convert 'me' output into human-readable text."""
-    template = JINJA2_ENV.get_template("me_result.txt.j2")
+    return ansi_markup(get_template("me_result.txt.j2").render(result=result, verbose=verbose))
 
-    return template.render(result=result, verbose=verbose)
 
-
-@colored_output
 def feedback_formatter(result, verbose):
     """Convert 'feedback' output into human-readable text."""
-    template = JINJA2_ENV.get_template("feedback_result.txt.j2")
-
-    return template.render(result=result, verbose=verbose)
+    return ansi_markup(get_template("feedback_result.txt.j2").render(result=result, verbose=verbose))
 
 
+# keyed by (output format, subcommand name); json output does not depend
+# on the subcommand
 FORMATTERS = {
-    "json": json_formatter,
-    "txt": {
-        "me": me_formatter,
-        "feedback": feedback_formatter,
-        "create": mdm_formatter,
-        "analyze": analyze_formatter
-    },
+    ("json", None): json_formatter,
+    ("txt", "me"): me_formatter,
+    ("txt", "feedback"): feedback_formatter,
+    ("txt", "create"): mdm_formatter,
+    ("txt", "analyze"): analyze_formatter,
 }
@@ -1,8 +1,12 @@
 """CLI subcommands."""
 
 import os
+import copy
+import hashlib
 import platform
 import base64
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 import click
 import structlog
@@ -17,16 +21,23 @@ from sublime.cli.decorator import (
     create_command,
     binexplode_command,
     not_implemented_command,
+    get_api_client,
     MissingRuleInput
 )
-from sublime.util import *
-from sublime.error import AuthenticationError
-
-# for the listen subcommand
-import ssl
-import asyncio
-from functools import wraps
-from sublime.cli.formatter import FORMATTERS 
+from sublime.util import (
+    CONFIG_FILE,
+    iter_files,
+    load_eml,
+    load_eml_file_handle,
+    load_mbox,
+    load_msg,
+    load_msg_file_handle,
+    load_yml_file,
+    load_yml_path,
+    request_permission,
+    save_config,
+)
+from sublime.error import AuthenticationError, LoadRuleError
 
 LOGGER = structlog.get_logger()
 
@@ -37,11 +48,6 @@ def help_(context):
     """Show this message and exit."""
     click.echo(context.parent.get_help())
 
-def clear():
-    """Clear the console"""
-    # check and make call for appropriate operating system
-    os.system('clear' if os.name =='posix' else 'cls')
-
 
 @create_command
 @click.option("-v", "--verbose", count=True, help="Verbose output")
@@ -72,6 +78,58 @@ def create(
     return results
 
 
+def name_sort_key(item):
+    """Sort rules and queries by name, ignoring case; unnamed ones first."""
+    return (item.get('name') or '').lower()
+
+
+def analyze_message_once(api_client, raw_message, rules, queries, responses,
+        responses_lock):
+    """Analyze a message, reusing the response for an identical message.
+
+    Safe to call from several threads sharing the same responses; a message
+    that is already being analyzed waits for that request instead of
+    sending another one.
+
+    :param api_client: API client
+    :type api_client: Sublime
+    :param raw_message: Base64 encoded raw message
+    :type raw_message: str
+    :param rules: Rules to run
+    :type rules: list
+    :param queries: Queries to run
+    :type queries: list
+    :param responses: Pending and received responses, keyed by message digest
+    :type responses: dict
+    :param responses_lock: Lock guarding responses
+    :type responses_lock: threading.Lock
+    :returns: A copy of the analysis response that the caller may modify
+    :rtype: dict
+
+    """
+    digest = hashlib.blake2b(
+            raw_message.encode('ascii'), digest_size=16).digest()
+    with responses_lock:
+        response = responses.get(digest)
+        owner = response is None
+        if owner:
+            response = responses[digest] = Future()
+
+    if owner:
+        try:
+            response.set_result(api_client.analyze_message(
+                    raw_message,
+                    rules,
+                    queries))
+        except Exception as exception:
+            # let a later copy of the message try again
+            with responses_lock:
+                del responses[digest]
+            response.set_exception(exception)
+
+    return copy.deepcopy(response.result())
+
+
 @analyze_command
 @click.option("-v", "--verbose", count=True, help="Verbose output")
 def analyze(
@@ -85,6 +143,8 @@ def analyze(
     mailbox_email_address,
     output_file,
     output_format,
+    parallel,
+    no_cache,
     verbose,
 ):
     """Analyze a file or directory of EMLs, MSGs, MDMs or MBOX files."""
@@ -97,14 +157,13 @@ def analyze(
     rules, queries = [], []
     if run_path:
         if os.path.isfile(run_path):
-            with open(run_path, encoding='utf-8') as f:
-                try:
-                    rules, queries = load_yml(f)
-                except LoadRuleError as error:
-                    LOGGER.warning(error.message)
+            try:
+                rules, queries = load_yml_file(run_path)
+            except LoadRuleError as error:
+                LOGGER.warning(error.message)
 
         elif os.path.isdir(run_path):
-            rules, queries = load_yml_path(run_path)
+            rules, queries = load_yml_path(run_path, use_cache=not no_cache)
 
     elif query:
         queries = [{
@@ -118,106 +177,111 @@ def analyze(
 
     # sort rules and queries in advance so we don't have to later
     # analyze endpoint should conserve the order in which they're submitted
-    rules = sorted(rules, key=lambda i: i['name'].lower() if i.get('name') else '')
-    queries = sorted(queries, key=lambda i: i['name'].lower() if i.get('name') else '')
+    rules.sort(key=name_sort_key)
+    queries.sort(key=name_sort_key)
 
     # aggregate all files we need to check
     file_paths = []
     if os.path.isfile(input_path):
         file_paths.append(input_path)
     else:
-        for extension in ['msg', 'eml', 'mbox']:
-            for file_path in Path(input_path).rglob('*.' + extension):
-                file_paths.append(str(file_path))
+        # walk the tree once, keeping .msg files first, then .eml and .mbox
+        files_by_extension = {'.msg': [], '.eml': [], '.mbox': []}
+        for file_path in iter_files(input_path, tuple(files_by_extension)):
+            _, _, extension = file_path.rpartition('.')
+            files_by_extension['.' + extension].append(file_path)
+        for extension_file_paths in files_by_extension.values():
+            file_paths.extend(extension_file_paths)
     if not file_paths:
         LOGGER.error("Input file(s) must have .eml, .msg, or .mbox extension")
         context.exit(-1)
 
-    # analyze each file and aggregate all responses
-    results = {}
-    errors = []
+    # responses by message digest, shared by the workers
+    responses = {}
+    responses_lock = threading.Lock()
+
+    def analyze_one(load, source):
+        raw_message = load(source) if load else source
+        return analyze_message_once(
+                api_client,
+                raw_message,
+                rules,
+                queries,
+                responses,
+                responses_lock)
+
+    # collect every message to analyze in the order results are reported;
+    # .eml and .msg files are loaded by the workers, .mbox files are split
+    # into their messages up front
+    messages = []
     num_files = len(file_paths)
     with Halo(text="", spinner='dots') as halo:
         for i in range(num_files):
-            halo.start()
             file_path = file_paths[i]
-            file_dir, _, file_name = file_path.rpartition('/')
-            _, _, extension = file_name.rpartition('.')
-            halo_text = f"Analyzing file {i+1} of {num_files} ( {file_name} )"
-            halo.text = halo_text
-
             if file_path.endswith('.msg'):
-                try:
-                    raw_message = load_msg(file_path)
-                    response = api_client.analyze_message(
-                            raw_message, 
-                            rules,
-                            queries)
-                except Exception as exception:
-                    if isinstance(exception, AuthenticationError):
-                        raise exception
-                    else:
-                        halo.stop()
-                        LOGGER.warning(f"failed to analyze ({file_name}): {exception}")
-                        errors.append(exception)
-                        continue
-
+                messages.append((file_path, None, load_msg, file_path))
             elif file_path.endswith('.eml'):
-                try:
-                    raw_message = load_eml(file_path)
-                    response = api_client.analyze_message(
-                            raw_message, 
-                            rules,
-                            queries)
-                except Exception as exception:
-                    if isinstance(exception, AuthenticationError):
-                        raise exception
-                    else:
-                        halo.stop()
-                        LOGGER.warning(f"failed to analyze ({file_name}): {exception}")
-                        errors.append(exception)
-                        continue
-
+                messages.append((file_path, None, load_eml, file_path))
             elif file_path.endswith('.mbox'):
                 # in the mbox case we want to retrieve the response for each message
                 # contained and provide a unique results key for each entry
                 mbox_files = load_mbox(file_path, halo=halo)
-                file_count = len(mbox_files)
-
-                count = 0
-                for subject_unique in mbox_files.keys():
-                    count += 1
-                    halo_suffix = f" message {count} of {file_count}..."
-                    halo.text = halo_text + halo_suffix
-                    try:
-                        response = api_client.analyze_message(
-                                mbox_files[subject_unique], 
-                                rules,
-                                queries)
-                    except Exception as exception:
-                        if isinstance(exception, AuthenticationError):
-                            raise exception
-                        else:
-                            halo.stop()
-                            LOGGER.warning(f"failed to analyze ({file_name}): {exception}")
-                            errors.append(exception)
-                            continue
-
-                    response['file_name'] = file_name
-                    response['extension'] = extension
-                    response['directory'] = file_dir
-                    response['subject'] = subject_unique
-                    results[file_path+subject_unique] = response
-                continue
-                    
+                for subject_unique, raw_message in mbox_files.items():
+                    messages.append((file_path, subject_unique, None, raw_message))
             else:
                 LOGGER.error("Input file(s) must have .eml, .msg, or .mbox extension")
                 context.exit(-1)
-            
-            response['file_name'] = file_name
-            response['extension'] = extension
-            response['directory'] = file_dir
+
+        # analyze the messages concurrently, reporting progress and failures
+        # from this thread as the requests complete
+        analyzed = [None] * len(messages)
+        errors = []
+        num_messages = len(messages)
+        # every worker shares the client's session, so it needs a connection
+        # for each of them to keep alive
+        api_client.set_pool_size(parallel)
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {
+                executor.submit(analyze_one, load, source): index
+                for index, (_, _, load, source) in enumerate(messages)
+            }
+            try:
+                for count, future in enumerate(as_completed(futures), start=1):
+                    halo.text = f"Analyzed {count} of {num_messages} messages"
+                    index = futures[future]
+                    try:
+                        analyzed[index] = future.result()
+                    except AuthenticationError:
+                        raise
+                    except Exception as exception:
+                        file_name = messages[index][0].rpartition('/')[2]
+                        halo.stop()
+                        LOGGER.warning(f"failed to analyze ({file_name}): {exception}")
+                        errors.append(exception)
+                        halo.start()
+            except BaseException:
+                # e.g. an invalid API key or ctrl-c: don't send the messages
+                # still queued, only wait for the requests in flight
+                for future in futures:
+                    future.cancel()
+                raise
+
+    # aggregate all responses
+    results = {}
+    for (file_path, subject_unique, _, _), response in zip(messages, analyzed):
+        if response is None:
+            continue
+
+        file_dir, _, file_name = file_path.rpartition('/')
+        _, _, extension = file_name.rpartition('.')
+        response['file_name'] = file_name
+        response['extension'] = extension
+        response['directory'] = file_dir
+        if subject_unique is None:
             results[file_path] = response
+        else:
+            response['subject'] = subject_unique
+            results[file_path+subject_unique] = response
 
     # raise the first error we saw if there were no successful results
     if len(results) == 0: raise errors[0] 
@@ -290,6 +354,8 @@ def setup(api_key="", save_dir=""):
     """Configure defaults."""
     config = {"api_key": api_key, "save_dir": save_dir, "permission": ""}
     save_config(config)
+    # clients created before this point may hold the old key
+    get_api_client.cache_clear()
     click.echo("Configuration saved to {!r}".format(CONFIG_FILE))
 
 
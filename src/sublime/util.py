@@ -1,28 +1,53 @@
 """Utility and helper functions."""
 
 import os
-import socket
 import sys
-import email
-import mailbox
 import base64
-import json
+import functools
+import hashlib
+import mmap
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePath
 
-import yaml
 import click
+import orjson
 import structlog
-import msg_parser
-from halo import Halo
 from six.moves.configparser import ConfigParser
-from pathlib import Path
 
-from sublime.error import *
+from sublime.error import (
+    LoadEMLError,
+    LoadMSGError,
+    LoadMessageDataModelError,
+    LoadRuleError,
+)
 
 CONFIG_FILE = os.path.expanduser(os.path.join("~", ".config", "sublime", "setup.cfg"))
 LOGGER = structlog.get_logger()
 
+# number of rule files read and parsed concurrently
+LOAD_YML_WORKERS = 8
+# large enough to read most rule files with a single read call
+YML_BUFFER_SIZE = 1 << 17
+# .eml files of at least this size are memory-mapped instead of read
+EML_MMAP_THRESHOLD = 1 << 16
+
+# rules and queries last loaded by load_yml_path for each directory, along
+# with whether errors were ignored and the signature of the files read
+YML_PATH_CACHE = {}
+# rules and queries parsed by earlier runs are kept in one json file per
+# directory, under $XDG_CACHE_HOME/sublime or ~/.cache/sublime
+RULES_CACHE_DIR_NAME = "sublime"
+
 DEFAULT_CONFIG = {"api_key": "", "save_dir": "", "permission": ""}
 
+DATETIME_FORMATS = (
+    '%Y-%m-%d',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+    '%Y-%m-%d %H:%M:%S',
+)
+
 CONFIRMATION_MESSAGE_GENERIC = """
     Messages will be sent to Sublime Security servers in order to be processed.
     
@@ -166,15 +191,25 @@ def load_eml(input_file):
     :raises: LoadEMLError
 
     """
-    with open(input_file) as f:
-        return load_eml_file_handle(f)
+    with open(input_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size < EML_MMAP_THRESHOLD:
+            return load_eml_file_handle(f)
+
+        # encode larger files straight from the page cache rather than
+        # reading a copy of them first
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as raw_message:
+                return base64.b64encode(raw_message).decode('ascii')
+        except Exception as exception:
+            error_message = "{}".format(exception)
+            raise LoadEMLError(error_message)
 
 
 def load_eml_file_handle(input_file):
     """Load .EML file.
 
-    :param input_file: File handle.
-    :type input_file: _io.TextIOWrapper
+    :param input_file: File handle opened in binary mode.
+    :type input_file: _io.BufferedReader
     :returns: Base64-encoded raw content
     :rtype: string
     :raises: LoadEMLError
@@ -184,12 +219,9 @@ def load_eml_file_handle(input_file):
         raise LoadEMLError("Missing .eml file")
 
     try:
-        message = email.message_from_file(input_file)
+        # the API takes the raw message, so there is no need to parse it
         raw_message_base64 = base64.b64encode(
-                message.as_string().encode('utf-8')).decode('ascii')
-
-        # fails for utf-8 messages:
-        # decoded = base64.b64encode(message.as_bytes()).decode('ascii') 
+                input_file.read()).decode('ascii')
     except Exception as exception:
         error_message = "{}".format(exception)
         raise LoadEMLError(error_message)
@@ -207,7 +239,6 @@ def load_msg(filepath):
     :raises: LoadMSGError
 
     """
-
     with open(filepath) as f:
         return load_msg_file_handle(f)
 
@@ -225,6 +256,9 @@ def load_msg_file_handle(input_file):
     if input_file is None:
         raise LoadMSGError("Missing .msg file")
 
+    # only needed for .msg input and slow to import
+    import msg_parser
+
     try:
         msg_obj = msg_parser.MsOxMessage(input_file.name)
         email_formatter = msg_parser.email_builder.EmailFormatter(msg_obj)
@@ -252,26 +286,33 @@ def load_mbox(filepath, halo=None):
         _, _, file_name = filepath.rpartition('/')
         halo.text = f"Loading ({file_name}) this may take a while..."
 
+    # only needed for .mbox input
+    import email.parser
+    import mailbox
+
     raw_messages = {}
     mbox = mailbox.mbox(filepath)
     num_messages = len(mbox)
+    # only the headers are needed to name each message
+    header_parser = email.parser.BytesHeaderParser()
 
     for i in range(num_messages):
-        message = mbox[i]
+        # encode the raw bytes as stored in the mbox, without building and
+        # re-serializing a full message object
+        raw_message = mbox.get_bytes(i)
         if halo:
             halo.text = f"Encoding ({file_name}) message {i+1} of {num_messages}"
 
         try:
             # identify a suitable key for this message
             instance = 0
-            subject = message['subject'] or "[Empty Subject]"
+            headers = header_parser.parsebytes(raw_message)
+            subject = headers['subject'] or "[Empty Subject]"
             key = subject
             while key in raw_messages:
                 instance += 1
                 key = subject + f" ({instance})"
 
-            # encode the raw message and return
-            raw_message = message.as_string().encode('utf-8')
             raw_messages[key] = base64.b64encode(raw_message).decode('ascii')
 
         except Exception as exception:
@@ -292,7 +333,7 @@ def load_message_data_model(filepath):
     :raises: LoadMessageDataModelError
 
     """
-    with open(filepath) as f:
+    with open(filepath, "rb") as f:
         return load_message_data_model_file_handle(f)
 
 
@@ -300,7 +341,7 @@ def load_message_data_model_file_handle(input_file):
     """Load Message Data Model file.
 
     :param input_file: File handle.
-    :type input_file: _io.TextIOWrapper
+    :type input_file: _io.BufferedReader or _io.TextIOWrapper
     :returns: Message Data Model JSON object
     :rtype: dict
     :raises: LoadMessageDataModelError
@@ -310,7 +351,7 @@ def load_message_data_model_file_handle(input_file):
         raise LoadMessageDataModelError("Missing Message Data Model file")
     
     try:
-        message_data_model = json.load(input_file)
+        message_data_model = orjson.loads(input_file.read())
     except Exception as exception:
         error_message = "{}".format(exception)
         raise LoadMessageDataModelError(error_message)
@@ -318,31 +359,153 @@ def load_message_data_model_file_handle(input_file):
     return message_data_model
 
 
-def load_yml_path(files_path, ignore_errors=True):
+def iter_files(root, extensions):
+    """Recursively find files with the given extensions.
+
+    Walks the tree with os.scandir, which reports entry types without an
+    extra stat per entry. Symbolic links to directories are not followed.
+    The root is normalized as pathlib does, so "./in/" yields "in/a.eml".
+
+    :param root: Directory to search
+    :type root: str
+    :param extensions: File name suffixes to match, e.g. (".yml", ".yaml")
+    :type extensions: tuple
+    :returns: Paths of the matching files
+    :rtype: generator of str
+
+    """
+    directories = [str(PurePath(root))]
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                subdirectories = []
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.name.endswith(extensions):
+                        yield entry.path
+        except OSError:
+            # e.g. missing or unreadable directories, as with rglob
+            continue
+        # visit subdirectories in the order they were listed
+        directories.extend(reversed(subdirectories))
+
+
+def load_yml_path(files_path, ignore_errors=True, use_cache=True):
     """Load rules and queries from a path.
 
     :param files_path: Path to YML files
     :type files_path: string
     :param ignore_errors: Ignore file loading errors
     :type ignore_errors: boolean
+    :param use_cache: Reuse rules and queries parsed earlier. If false, any
+        cached rules and queries for the path are deleted.
+    :type use_cache: boolean
     :returns: A list of rules and a list of queries
     :rtype: list, list
     :raises: LoadRuleError
 
     """
-    # gather all rules files
-    sqar_files = []
-    for file in Path(files_path).rglob("*.yml"):
-        sqar_files.append(file)
-    for file in Path(files_path).rglob("*.yaml"):
-        sqar_files.append(file)
-
-    # get all rules and queries from
+    # gather all rules files, .yml first then .yaml
+    yml_files, yaml_files = [], []
+    for file in iter_files(files_path, (".yml", ".yaml")):
+        if file.endswith(".yml"):
+            yml_files.append(file)
+        else:
+            yaml_files.append(file)
+    sqar_files = yml_files + yaml_files
+
+    # reuse the rules and queries parsed earlier if no file has changed
+    signature = get_files_signature(sqar_files)
+    cache_key = os.path.abspath(files_path)
+    cached = YML_PATH_CACHE.get(cache_key)
+    if not use_cache:
+        clear_rules_cache(files_path)
+        rules, queries = load_yml_files(sqar_files, ignore_errors)
+    elif cached and cached[:2] == (ignore_errors, signature):
+        _, _, rules, queries = cached
+        rules = [dict(rule) for rule in rules]
+        queries = [dict(query) for query in queries]
+    else:
+        # files unchanged since an earlier run are not parsed again
+        cache_path = get_rules_cache_path(files_path)
+        loaded = read_rules_cache(cache_path, signature)
+        loaded_before = dict(loaded)
+        rules, queries = load_yml_files(sqar_files, ignore_errors, loaded)
+        if loaded != loaded_before:
+            write_rules_cache(cache_path, signature, loaded)
+        # keep copies so callers can modify the rules and queries returned
+        YML_PATH_CACHE[cache_key] = (
+            ignore_errors, signature,
+            [dict(rule) for rule in rules], [dict(query) for query in queries])
+
+    if len(rules) == 0 and len(queries) == 0:
+        LOGGER.warning(f"No valid YAML files found in {files_path}")
+
+    return rules, queries
+
+
+def clear_yml_path_cache():
+    """Forget the rules and queries loaded by load_yml_path."""
+    YML_PATH_CACHE.clear()
+
+
+def clear_rules_cache(files_path):
+    """Delete the rules and queries cached for a directory.
+
+    :param files_path: Path to YML files
+    :type files_path: string
+
+    """
+    clear_yml_path_cache()
+    try:
+        os.remove(get_rules_cache_path(files_path))
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        LOGGER.debug(f"failed to delete rules cache: {error}")
+
+
+def load_yml_files(file_paths, ignore_errors=True, loaded=None):
+    """Load rules and queries from a list of files.
+
+    The files are read and parsed concurrently, but the results are
+    collected in the order of the list.
+
+    :param file_paths: Paths to YML files
+    :type file_paths: list
+    :param ignore_errors: Ignore file loading errors
+    :type ignore_errors: boolean
+    :param loaded: Rules and queries already loaded, keyed by file path.
+        Files found in it are not read again, and files that load cleanly
+        with at least one rule or query are added to it.
+    :type loaded: dict
+    :returns: A list of rules and a list of queries
+    :rtype: list, list
+    :raises: LoadRuleError
+
+    """
+    if loaded is None:
+        loaded = {}
+
     rules, queries = [], []
-    for file in sqar_files:
-        with file.open(encoding='utf-8') as f:
+    max_workers = min(LOAD_YML_WORKERS, len(file_paths)) or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            None if file in loaded else executor.submit(load_yml_file, file)
+            for file in file_paths
+        ]
+        for file, future in zip(file_paths, futures):
             try:
-                rules_tmp, queries_tmp = load_yml(f)
+                if future is None:
+                    rules_tmp, queries_tmp = loaded[file]
+                else:
+                    rules_tmp, queries_tmp = future.result()
+                    # files without rules or queries may have been skipped
+                    # with a warning, keep reporting it
+                    if rules_tmp or queries_tmp:
+                        loaded[file] = (rules_tmp, queries_tmp)
                 if rules_tmp:
                     rules.extend(rules_tmp)
                 if queries_tmp:
@@ -354,12 +517,159 @@ def load_yml_path(files_path, ignore_errors=True):
                 else:
                     raise
 
-    if len(rules) == 0 and len(queries) == 0:
-        LOGGER.warning(f"No valid YAML files found in {files_path}")
-
     return rules, queries
 
 
+def get_files_signature(file_paths):
+    """Summarize the state of a list of files.
+
+    :param file_paths: Paths to files
+    :type file_paths: list
+    :returns: Path, modification time and size of every file; files that
+        cannot be read are recorded without the latter two
+    :rtype: tuple
+
+    """
+    signature = []
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+            signature.append((file_path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((file_path, None, None))
+
+    return tuple(signature)
+
+
+def get_rules_cache_dir():
+    """Get the directory holding the rules cache files.
+
+    :returns: Path of the cache directory
+    :rtype: str
+
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        cache_home = os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(cache_home, RULES_CACHE_DIR_NAME)
+
+
+def get_rules_cache_path(files_path):
+    """Get the path of the rules cache file for a directory.
+
+    :param files_path: Path to YML files
+    :type files_path: string
+    :returns: Path of the cache file
+    :rtype: str
+
+    """
+    digest = hashlib.blake2b(
+            os.path.abspath(files_path).encode('utf-8'),
+            digest_size=16).hexdigest()
+    return os.path.join(get_rules_cache_dir(), f"rules-{digest}.json")
+
+
+def read_rules_cache(cache_path, signature):
+    """Read the rules and queries cached for files that have not changed.
+
+    :param cache_path: Path of the cache file
+    :type cache_path: str
+    :param signature: Current signature of the files, see get_files_signature
+    :type signature: tuple
+    :returns: Rules and queries keyed by file path; empty if the cache is
+        missing or unreadable
+    :rtype: dict
+
+    """
+    try:
+        with open(cache_path, "rb") as f:
+            cached_files = orjson.loads(f.read())["files"]
+
+        loaded = {}
+        for file_path, mtime_ns, size in signature:
+            entry = cached_files.get(os.path.abspath(file_path))
+            if entry and mtime_ns is not None and \
+                    entry["mtime_ns"] == mtime_ns and entry["size"] == size:
+                loaded[file_path] = (entry["rules"], entry["queries"])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        # a missing or corrupt cache just means parsing the files again
+        return {}
+
+    return loaded
+
+
+def write_rules_cache(cache_path, signature, loaded):
+    """Save the rules and queries loaded from a directory for later runs.
+
+    Failing to write the cache is not an error.
+
+    :param cache_path: Path of the cache file
+    :type cache_path: str
+    :param signature: Signature of the files when they were loaded
+    :type signature: tuple
+    :param loaded: Rules and queries keyed by file path
+    :type loaded: dict
+
+    """
+    cached_files = {}
+    for file_path, mtime_ns, size in signature:
+        if file_path in loaded and mtime_ns is not None:
+            rules, queries = loaded[file_path]
+            cached_files[os.path.abspath(file_path)] = {
+                "mtime_ns": mtime_ns,
+                "size": size,
+                "rules": rules,
+                "queries": queries,
+            }
+
+    try:
+        data = orjson.dumps({"files": cached_files})
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so readers never see a partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except (OSError, TypeError, orjson.JSONEncodeError) as error:
+        LOGGER.debug(f"failed to write rules cache {cache_path}: {error}")
+
+
+def load_yml_file(file_path):
+    """Load rules and queries from a file path.
+
+    :param file_path: Path to YML file
+    :type file_path: str
+    :returns: A list of rules and a list of queries
+    :rtype: list, list
+    :raises: LoadRuleError
+
+    """
+    with open(file_path, encoding='utf-8', buffering=YML_BUFFER_SIZE) as f:
+        return load_yml(f)
+
+
+@functools.lru_cache(maxsize=1)
+def get_yaml_loader():
+    """Get the YAML loader for rule files, importing PyYAML on first use.
+
+    :returns: libyaml's CSafeLoader when PyYAML was built with it,
+        SafeLoader otherwise
+    :rtype: type
+
+    """
+    try:
+        from yaml import CSafeLoader as loader
+    except ImportError:
+        from yaml import SafeLoader as loader
+
+    return loader
+
+
 def load_yml(yml_file, ignore_errors=True):
     """Load rules and queries from a file.
 
@@ -379,8 +689,10 @@ def load_yml(yml_file, ignore_errors=True):
         else:
             raise LoadRuleError("Missing YML file")
 
+    import yaml
+
     try:
-        rules_and_queries_yaml = yaml.load(yml_file, Loader=yaml.SafeLoader)
+        rules_and_queries_yaml = yaml.load(yml_file, Loader=get_yaml_loader())
         if not rules_and_queries_yaml or not isinstance(rules_and_queries_yaml, dict):
             if ignore_errors:
                 LOGGER.warning("Invalid YML file")
@@ -449,11 +761,4 @@ def load_yml(yml_file, ignore_errors=True):
 
 
 def get_datetime_formats():
-    formats=[
-            '%Y-%m-%d',
-            '%Y-%m-%dT%H:%M:%S',
-            '%Y-%m-%dT%H:%M:%S.%f%z',
-            '%Y-%m-%d %H:%M:%S'
-    ]
-
-    return formats
+    return DATETIME_FORMATS